@@ -1,17 +1,24 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
 import numpy as np
-import folium
-from streamlit_folium import folium_static
-from folium.plugins import MarkerCluster
 from streamlit_option_menu import option_menu
-import plotly.express as px
 from datetime import datetime
+import os
+import time
+import json
+import uuid
+from pipeline import (memory_report, hypothesis_data, finding, select_zipcodes, within_radius, BUY_RULES,
+                      MARKUP_TIERS, rule_default, whatif, view, price_trend, CACHE_DIR, REFRESH_INTERVAL,
+                      start_refresh, snapshot_artifact, build_map, start_trace, stage)
 
 
 # increase page layout
 st.set_page_config(layout='wide')
 
+# stages of this run, for the profiling panel and the JSON log
+trace = start_trace(st.session_state.setdefault('trace_session', uuid.uuid4().hex[:12]))
+
 # Sidebar
 with st.sidebar:
     selected = option_menu("Menu", ['Introduction', 'Insights', 'Conclusion'],
@@ -21,12 +28,46 @@ with st.sidebar:
 col1, col2, col3 = st.columns(3)
 col2.image('img1.png')
 
-@st.cache(allow_output_mutation=True)
-def get_data(path):
-    data = pd.read_csv(path)
-    return data
+# one argsort per (version, column) shared by every session - a singleton hands out the array itself,
+# where a memo would pickle and copy it on every interaction, so it is made read-only
+@st.experimental_singleton
+def get_sort_order(version, column, _data):
+    order = np.argsort(_data[column].to_numpy(), kind='mergesort')
+    order.setflags(write=False)
+    return order
+
+# the memory report reads the whole CSV, so it is built once per dataset version
+@st.experimental_memo
+def get_memory_report(version, _data):
+    report = memory_report(path, _data)
+    return report
+
+def dataset_viewer(data, version):
+
+    # columns and sorting
+    c1, c2, c3 = st.columns(3)
+    columns = c1.multiselect('Columns', list(data.columns), default=list(data.columns)[:8])
+    sort = c2.selectbox('Sort by', ['-'] + list(data.columns))
+    ascending = c3.radio('Order', ['ascending', 'descending'], horizontal=True) == 'ascending'
+
+    # filters and paging
+    c1, c2, c3, c4 = st.columns(4)
+    zipcodes = c1.multiselect('Zipcode', list(data['zipcode'].cat.categories))
+    low, high = int(data['price'].min()), int(data['price'].max())
+    price = c2.slider('Price (US$)', min_value=low, max_value=high, value=(low, high), step=1000)
+    page_size = c3.selectbox('Rows per page', [25, 50, 100, 500], index=1)
+    page = c4.number_input('Page', min_value=1, value=1, step=1)
+
+    # only the visible rows and columns leave the server
+    order = None if sort == '-' else get_sort_order(version, sort, data)
+    frame, stats = view(data, columns, page, page_size, None if sort == '-' else sort, ascending,
+                        zipcodes, price, order)
+    st.dataframe(frame)
+    st.caption('Page {page} of {pages} - {rows} of {matches} rows, {columns} columns, {kb:.1f} KB sent'.format(**stats))
+
+    return None
 
-def introduction(data):
+def introduction(data, version):
 
     if selected == 'Introduction':
 
@@ -42,7 +83,11 @@ def introduction(data):
         st.header('The Data')
         b_dataset = st.checkbox('Display Dataset')
         if b_dataset:
-            st.dataframe(data)
+            dataset_viewer(data, version)
+
+        b_memory = st.checkbox('Display Memory Usage')
+        if b_memory:
+            st.dataframe(get_memory_report(version, data))
 
         # Assumptions
         st.header('Assumptions')
@@ -60,192 +105,112 @@ def introduction(data):
 
     return None
 
-def set_feature(data):
-
-    # == Change Types ==
-
-    # add new feature
-    data['price_m2'] = data['price'] / data['sqft_lot']
-
-    # change the "date" column from type "object" to "datetime"
-    data['date'] = pd.to_datetime(data['date'])
-
-    # change the "yr_built" and "yr_renovated" columns from type "int" to "datetime"
-    data['yr_built'] = pd.to_datetime(data['yr_built'], format='%Y')
-
-    # if "yr_renovated" value is equal to "0", replace with "1900"
-    data['yr_renovated'] = data['yr_renovated'].apply(lambda x: pd.to_datetime('1900', format='%Y') if x == 0 else
-    pd.to_datetime(x, format='%Y'))
-
-    # change the "waterfront" column to "str" type
-    data['waterfront'] = data['waterfront'].astype(str)
-
-    # change the "condition" column to "str" type
-    data['condition'] = data['condition'].astype(str)
-
-
-    # == Line Filtering ==
-
-    # remove row with outlier from the "bedrooms" column
-    data = data.drop(data[data['bedrooms'] == 33].index)
-
-    # sort values by 'id' and 'date'
-    data = data.sort_values(['id', 'date'])
-
-    # keep only recent rows by dropping previous dates
-    data = data.drop_duplicates(subset=['id'], keep='last').reset_index()
-
-    # drop extra index column
-    data = data.drop(columns=['index'])
-
-    # == Column Selection ==
-
-    # select columns to drop
-    cols_drop = ['sqft_living15', 'sqft_lot15']
-
-    # drop selected columns
-    data = data.drop(columns=cols_drop)
-
-
-    # == Hypotheses ==
-
-    # H1
-    # add new column with waterfront option ("yes" or "no")
-    data['waterfront_option'] = data['waterfront'].apply(lambda x: 'yes' if x == '1' else 'no')
-
-    # H2
-    # create new column with before and after 1955 values
-    data['is_before_1955'] = data['yr_built'].apply(lambda x: 'before' if x.year < 1955 else 'after')
-
-    # H3
-    # create 'basement' column
-    data['basement_option'] = data['sqft_basement'].apply(lambda x: 'no basement' if x == 0 else 'basement')
-
-    # H4
-    # create 'year' column
-    data['year'] = data['date'].dt.year
-
-    # H5
-    # create new column with year-month format
-    data['month_year'] = data['date'].dt.strftime('%Y-%m')
+# rebuild the transformed dataset even if cached, over this many processes
+REBUILD = os.environ.get('HOUSE_ROCKET_REBUILD') == '1'
+WORKERS = int(os.environ.get('HOUSE_ROCKET_WORKERS', '1'))
 
-    # H6
-    # create new column with floor amount
-    data['is_floor'] = data['floors'].apply(lambda x: 'ground floor' if x == 1 else 'more floors')
+# seconds between checks of the source file for a new version
+REFRESH = float(os.environ.get('HOUSE_ROCKET_REFRESH', REFRESH_INTERVAL))
 
-    # H7
-    # create month column
-    data['month'] = data['date'].dt.strftime('%m')
+# show the profiling panel in the sidebar
+DEBUG = os.environ.get('HOUSE_ROCKET_DEBUG') == '1'
 
-    # change from object format to int
-    data['month'] = data['month'].astype('int64')
+# one refresh thread per process - it maps the datasets once (memory-mapped snapshots shared by every
+# session and process, read-only) and swaps in a new snapshot when kc_house_data.csv changes
+@st.experimental_singleton
+def get_refresher(path):
+    refresher = start_refresh(path, REFRESH, REBUILD, WORKERS)
+    return refresher
 
-    # create column with season
-    data['season'] = data['month'].apply(lambda x: 'Summer' if 6 <= x <= 8 else
-    'Fall' if 9 <= x <= 11 else
-    'Winter' if (x == 12) or (x == 1) or (x == 2) else
-    'Spring' if 3 <= x <= 5 else None)
+def percent(uplift):
 
-    # H8
-    # create column with renovation option
-    data['is_renovated'] = data['yr_renovated'].apply(
-        lambda x: 'not renovated' if x.strftime('%Y') == '1900' else 'renovated')
+    # 2.1176 -> "212%", -0.004 -> "0.4%"
+    value = abs(uplift) * 100
+    return '{:.1f}%'.format(value) if value < 1 else '{:.0f}%'.format(value)
 
-    # H9
-    # create column with before and after 2010 renovation values
-    data['renovated_2010'] = data['yr_renovated'].apply(lambda x: 'before' if int(x.strftime('%Y')) < 2010 else 'after')
+def finding_text(cube, hypothesis, text):
 
-    # H10
-    # create column with condition type
-    data['condition_type'] = data['condition'].apply(lambda x: 'good' if int(x) >= 4 else 'bad')
+    # fill the verdict, the percentage and the direction of the finding into the text
+    uplift, holds = finding(cube, hypothesis)
+    if np.isnan(uplift):
+        return ':heavy_minus_sign: Insufficient data - the loaded dataset has no properties in one of the compared groups.'
 
-    # H11
-    # create column with bedroom amount
-    data['bedrooms_amount'] = data['bedrooms'].apply(lambda x: 'up to 2' if x <= 2 else 'more than 2')
+    verdict = ':heavy_check_mark: True' if holds else ':heavy_multiplication_x: False'
+    direction = 'more expensive' if uplift > 0 else 'cheaper'
 
-    # H12
-    # create column with bathroom amount
-    data['bathrooms_amount'] = data['bathrooms'].apply(lambda x: 'up to 1' if x <= 1 else 'more than 1')
+    return text.format(verdict=verdict, percent=percent(uplift), direction=direction)
 
-    # group by zipcode and return median price
-    grouped = data[['zipcode', 'price']].groupby('zipcode').median().reset_index()
+def finding_color(cube, hypothesis):
 
-    # rename column 'price' to 'median_price'
-    grouped = grouped.rename(columns={'price': 'median_price'})
+    # green bars for confirmed hypotheses, red otherwise, grey without enough data
+    uplift, holds = finding(cube, hypothesis)
+    if np.isnan(uplift):
+        return 'rgba(128, 128, 128, 0.6)'
 
-    # merge dataframes by zipcode - the new column shows median price per zipcode
-    data = pd.merge(data, grouped, on='zipcode', how='inner')
+    return 'rgba(0, 255, 17, 0.6)' if holds else 'rgba(255, 0, 0, 0.6)'
 
-    # create new empty column
-    data['status'] = 0
+# chart type and x axis of each hypothesis
+FIGURES = {
+    'H1': ('bar', 'waterfront_option'),
+    'H6': ('bar', 'is_floor'),
+    'H3': ('bar', 'basement_option'),
+    'H2': ('bar', 'is_before_1955'),
+    'H5': ('line', 'month_year'),
+    'H10': ('bar', 'condition_type'),
+    'H12': ('bar', 'bathrooms_amount'),
+    'H7': ('bar', 'season'),
+    'H11': ('bar', 'bedrooms_amount'),
+    'H9': ('bar', 'renovated_2010'),
+    'H8': ('bar', 'is_renovated'),
+}
 
+# most points drawn on the H5 line before months are merged into quarters or years
+TREND_POINTS = 36
 
-    # == "Buy"/"Don't buy" Feature ==
+def build_figure(cube, hypothesis):
 
-    # for each line (i) in dataframe
-    for i in range(len(data)):
+    # plotting stack is only needed on the Insights page, and only when a spec is not cached
+    import plotly.express as px
 
-        # if the conditions below
-        if (data.loc[i, 'price'] <= data.loc[i, 'median_price']) & (data.loc[i, 'condition_type'] == 'good') & (
-                data.loc[i, 'waterfront_option'] == 'no') & (data.loc[i, 'basement_option'] == 'no basement') & (
-                data.loc[i, 'is_floor'] == 'ground floor') & (data.loc[i, 'bedrooms'] <= 2) & (
-                data.loc[i, 'bathrooms_amount'] == 'up to 1'):
+    kind, x = FIGURES[hypothesis]
+    if kind == 'line':
+        fig = px.line(price_trend(cube, TREND_POINTS), x=x, y='price')
+    else:
+        fig = px.bar(hypothesis_data(cube, hypothesis), x=x, y='price')
+        fig.update_traces(marker_color=finding_color(cube, hypothesis))
 
-            # the empty column assign "buy"
-            data.loc[i, 'status'] = "buy"
+    return fig.to_json()
 
-        else:
-
-            # the empty column assign "don't buy"
-            data.loc[i, 'status'] = "don't buy"
-
-
-    # == Selling Dataframe ==
-
-    # group by zipcode and season and return the median price
-    grouped = data[['season', 'zipcode', 'price']].groupby(['zipcode', 'season']).median().reset_index()
-
-    # organize values by zipcode first and then price
-    grouped = grouped.sort_values(['zipcode', 'price'])
-
-    # keep the highest price only
-    grouped = grouped.drop_duplicates(subset=['zipcode'], keep='last').reset_index()
+@st.experimental_memo
+def get_figure(version, hypothesis, _cube, _record):
 
-    # drop index column
-    grouped = grouped.drop(columns='index')
+    # serialized spec per (dataset version, hypothesis), shared with other processes through the cache folder
+    spec_path = os.path.join(CACHE_DIR, 'figure-{}-{}.json'.format(version, hypothesis))
+    if os.path.exists(spec_path):
+        _record['cache'] = 'file'
+        with open(spec_path) as f:
+            return f.read()
 
-    # rename columns
-    grouped = grouped.rename(columns={'season': 'high_season', 'price': 'season_median_price'})
-    # filter columns by profitable houses (column 'status' equal to 'buy' value)
+    _record['cache'] = 'miss'
+    spec = build_figure(_cube, hypothesis)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = '{}.{}.tmp'.format(spec_path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(spec)
+    os.replace(tmp, spec_path)
 
-    # merge grouped dataset with general dataset by zipcode to return highest season median prices
-    data = pd.merge(data, grouped, on='zipcode', how='inner')
-    # create new column 'selling_price'
-    data['selling_price'] = 0
-
-
-    # == Selling price feature ==
-
-    # for each line in dataset
-    for i in range(len(data)):
-
-        # if 'price' is lower than 'season_median_price'
-        if (data.loc[i, 'price'] < data.loc[i, 'season_median_price']):
-
-            # column 'selling_price' receives 'price' plus 30%
-            data.loc[i, 'selling_price'] = (data.loc[i, 'price']) * 1.30
-
-        else:
+    return spec
 
-            # column 'selling_price' receives 'price' plus 10%
-            data.loc[i, 'selling_price'] = (data.loc[i, 'price']) * 1.10
+def figure(cube, version, hypothesis):
 
-    # create profit column
-    data['profit'] = data['selling_price'] - data['price']
+    # "hit" unless get_figure had to run
+    with stage('figure ' + hypothesis) as record:
+        record['cache'] = 'hit'
+        spec = json.loads(get_figure(version, hypothesis, cube, record))
 
-    return data
+    return spec
 
-def insights(data):
+def insights(cube, version):
 
     if selected == 'Insights':
 
@@ -256,127 +221,110 @@ def insights(data):
 
         # H1
         c1.subheader(':small_orange_diamond: Properties with waterfront are, on average, 30% more expensive.')
-        c1.write(':heavy_check_mark: True because properties with waterfront are, on average, 212% more expensive than properties without waterfront.')
-        # group by 'waterfront_option' and take average price
-        grouped = data[['waterfront_option', 'price']].groupby('waterfront_option').mean().reset_index()
-        fig = px.bar(grouped, x='waterfront_option', y='price')
-        fig.update_traces(marker_color='rgba(0, 255, 17, 0.6)')
-        c1.plotly_chart(fig, use_container_width=True)
+        c1.write(finding_text(cube, 'H1', '{verdict} because properties with waterfront are, on average, {percent} {direction} than properties without waterfront.'))
+        # average price by 'waterfront_option'
+        c1.plotly_chart(figure(cube, version, 'H1'), use_container_width=True)
 
         # H6
         c2.subheader(':small_orange_diamond: Ground floor properties are, on average, 40% cheaper.')
-        c2.write(':heavy_multiplication_x: False because ground floor properties are, on average, 30% cheaper than properties with more floors.')
-        # group by floor and return mean values
-        grouped = data[['price', 'is_floor']].groupby('is_floor').mean().reset_index()
-        # plot
-        fig = px.bar(grouped, x='is_floor', y='price')
-        fig.update_traces(marker_color='rgba(255, 0, 0, 0.6)')
-        c2.plotly_chart(fig, use_container_width=True)
+        c2.write(finding_text(cube, 'H6', '{verdict} because ground floor properties are, on average, {percent} {direction} than properties with more floors.'))
+        # average price by floor
+        c2.plotly_chart(figure(cube, version, 'H6'), use_container_width=True)
 
         # H3
         c1.subheader(':small_orange_diamond: Properties with a basement are, on average, 20% more expensive.')
-        c1.write(':heavy_check_mark: True because properties with a basement are, on average, 28% more expensive than properties without a basement.')
-        # group by basement
-        grouped = data[['basement_option', 'price']].groupby('basement_option').mean().reset_index()
-        # plot
-        fig = px.bar(grouped, x='basement_option', y='price')
-        fig.update_traces(marker_color='rgba(0, 255, 17, 0.6)')
-        c1.plotly_chart(fig, use_container_width=True)
+        c1.write(finding_text(cube, 'H3', '{verdict} because properties with a basement are, on average, {percent} {direction} than properties without a basement.'))
+        # average price by basement
+        c1.plotly_chart(figure(cube, version, 'H3'), use_container_width=True)
 
         # H2
         c2.subheader(':small_orange_diamond: Properties built before 1955 are, on average, 50% cheaper.')
-        c2.write(':heavy_multiplication_x: False because properties built before 1955 are only 0.4% cheaper, on average, than properties built after that year.')
-        # group data by "before" and "after" year 1955
-        grouped = data[['is_before_1955', 'price']].groupby('is_before_1955').mean().reset_index()
-        # plot
-        fig = px.bar(grouped, x='is_before_1955', y='price')
-        fig.update_traces(marker_color='rgba(255, 0, 0, 0.6)')
-        c2.plotly_chart(fig, use_container_width=True)
+        c2.write(finding_text(cube, 'H2', '{verdict} because properties built before 1955 are only {percent} {direction}, on average, than properties built after that year.'))
+        # average price "before" and "after" year 1955
+        c2.plotly_chart(figure(cube, version, 'H2'), use_container_width=True)
 
         # H5
         c1.subheader(':small_orange_diamond: Properties with 3 bathrooms have a month over month growth of 15%.')
-        c1.write(':heavy_multiplication_x: False because the growth was less than 15% in all months.')
-        # group by year-month and return the mean value
-        grouped = data[['price', 'month_year']].groupby('month_year').mean().reset_index()
-        # plot
-        fig = px.line(grouped, x='month_year', y='price')
-        #fig.update_traces(marker_color='rgba(255, 0, 0, 0.6)')
-        c1.plotly_chart(fig, use_container_width=True)
+        c1.write(finding_text(cube, 'H5', '{verdict} because the highest month over month growth was {percent}.'))
+        # average price by year-month
+        c1.plotly_chart(figure(cube, version, 'H5'), use_container_width=True)
 
         # H10
         c2.subheader(':small_orange_diamond: Properties in good condition are, on average, 50% more expensive.')
-        c2.write(':heavy_multiplication_x: False because properties in good condition are, on average, only 0.4% more expensive than properties in bad condition.')
-        # group by condition
-        grouped = data[['condition_type', 'price']].groupby('condition_type').mean().reset_index()
-        # plot
-        fig = px.bar(grouped, x='condition_type', y='price')
-        fig.update_traces(marker_color='rgba(255, 0, 0, 0.6)')
-        c2.plotly_chart(fig, use_container_width=True)
+        c2.write(finding_text(cube, 'H10', '{verdict} because properties in good condition are, on average, only {percent} {direction} than properties in bad condition.'))
+        # average price by condition
+        c2.plotly_chart(figure(cube, version, 'H10'), use_container_width=True)
 
         # H12
         c1.subheader(':small_orange_diamond: Properties with 1 bathroom are, on average, 30% cheaper.')
-        c1.write(':heavy_check_mark: True because properties with up to 1 bathroom are, on average, 40% cheaper than properties with more bathrooms.')
-        # group by bathroom amount
-        grouped = data.loc[:, ['price', 'bathrooms_amount']].groupby('bathrooms_amount').mean().reset_index()
-        # plot
-        fig = px.bar(grouped, x='bathrooms_amount', y='price')
-        fig.update_traces(marker_color='rgba(0, 255, 17, 0.6)')
-        c1.plotly_chart(fig, use_container_width=True)
+        c1.write(finding_text(cube, 'H12', '{verdict} because properties with up to 1 bathroom are, on average, {percent} {direction} than properties with more bathrooms.'))
+        # average price by bathroom amount
+        c1.plotly_chart(figure(cube, version, 'H12'), use_container_width=True)
 
         # H7
         c2.subheader(':small_orange_diamond: The price of real estate in winter is, on average, 20% cheaper than in summer.')
-        c2.write(':heavy_multiplication_x: False because real estate prices in winter are, on average, only 5% cheaper than in summer.')
-        # group by season and return mean price
-        grouped = data[['price', 'season']].groupby('season').mean().reset_index()
-        # plot
-        fig = px.bar(grouped, x='season', y='price')
-        fig.update_traces(marker_color='rgba(255, 0, 0, 0.6)')
-        c2.plotly_chart(fig, use_container_width=True)
+        c2.write(finding_text(cube, 'H7', '{verdict} because real estate prices in winter are, on average, only {percent} {direction} than in summer.'))
+        # average price by season
+        c2.plotly_chart(figure(cube, version, 'H7'), use_container_width=True)
 
         # H11
         c1.write('')
         c1.write('')
         c1.subheader(':small_orange_diamond: Properties with up to 2 bedrooms are, on average, 20% cheaper.')
-        c1.write(':heavy_check_mark: True because properties with up to 2 bedrooms are, on average, 30% cheaper than properties with more than 2 bedrooms.')
-        # group by bedroom
-        grouped = data.loc[:, ['bedrooms_amount', 'price']].groupby('bedrooms_amount').mean().reset_index()
-        # plot
-        fig = px.bar(grouped, x='bedrooms_amount', y='price')
-        fig.update_traces(marker_color='rgba(0, 255, 17, 0.6)')
-        c1.plotly_chart(fig, use_container_width=True)
+        c1.write(finding_text(cube, 'H11', '{verdict} because properties with up to 2 bedrooms are, on average, {percent} {direction} than properties with more than 2 bedrooms.'))
+        # average price by bedroom amount
+        c1.plotly_chart(figure(cube, version, 'H11'), use_container_width=True)
 
         # H9
         c2.subheader(':small_orange_diamond: Properties renovated after 2010, on average, 40% more expensive than properties previously renovated (or without renovation).')
-        c2.write(':heavy_multiplication_x: False because properties renovated after 2010 are, on average, 27% more expensive than previously renovated (or unrenovated) properties.')
-        # group by renovation
-        grouped = data.loc[:, ['renovated_2010', 'price']].groupby('renovated_2010').mean().reset_index()
-        # plot
-        fig = px.bar(grouped, x='renovated_2010', y='price')
-        fig.update_traces(marker_color='rgba(255, 0, 0, 0.6)')
-        c2.plotly_chart(fig, use_container_width=True)
+        c2.write(finding_text(cube, 'H9', '{verdict} because properties renovated after 2010 are, on average, {percent} {direction} than previously renovated (or unrenovated) properties.'))
+        # average price by renovation year
+        c2.plotly_chart(figure(cube, version, 'H9'), use_container_width=True)
 
         # H8
         c1.subheader(':small_orange_diamond: Unrenovated properties are, on average, 30% cheaper than renovated properties.')
-        c1.write(':heavy_check_mark: True because unrenovated properties are, on average, 30% cheaper than renovated properties.')
-        # group by renovation
-        grouped = data.loc[:, ['is_renovated', 'price']].groupby('is_renovated').mean().reset_index()
-        # plot
-        fig = px.bar(grouped, x='is_renovated', y='price')
-        fig.update_traces(marker_color='rgba(0, 255, 17, 0.6)')
-        c1.plotly_chart(fig, use_container_width=True)
+        c1.write(finding_text(cube, 'H8', '{verdict} because unrenovated properties are, on average, {percent} {direction} than renovated properties.'))
+        # average price by renovation
+        c1.plotly_chart(figure(cube, version, 'H8'), use_container_width=True)
 
         # Main Insights
         st.markdown("<h1 style='text-align: center; color: black;'>Main Insights</h1>", unsafe_allow_html=True)
         st.write('')
-        st.write(':small_orange_diamond: Ground floor properties are, on average, 30% cheaper than properties with more floors;')
-        st.write(':small_orange_diamond: Properties with waterfront are, on average, 212% more expensive than properties without waterfront;')
-        st.write(':small_orange_diamond: Properties with a basement are, on average, 28% more expensive than properties without a basement;')
-        st.write(':small_orange_diamond: Properties with up to 2 bedrooms are, on average, 30% cheaper than properties with more bedrooms;')
-        st.write(':small_orange_diamond: Properties with up to 1 bathroom are, on average, 40% cheaper than properties with more bathrooms.')
+        st.write(':small_orange_diamond: ' + finding_text(cube, 'H6', 'Ground floor properties are, on average, {percent} {direction} than properties with more floors;'))
+        st.write(':small_orange_diamond: ' + finding_text(cube, 'H1', 'Properties with waterfront are, on average, {percent} {direction} than properties without waterfront;'))
+        st.write(':small_orange_diamond: ' + finding_text(cube, 'H3', 'Properties with a basement are, on average, {percent} {direction} than properties without a basement;'))
+        st.write(':small_orange_diamond: ' + finding_text(cube, 'H11', 'Properties with up to 2 bedrooms are, on average, {percent} {direction} than properties with more bedrooms;'))
+        st.write(':small_orange_diamond: ' + finding_text(cube, 'H12', 'Properties with up to 1 bathroom are, on average, {percent} {direction} than properties with more bathrooms.'))
 
         return None
 
-def conclusion(data):
+def whatif_panel(model):
+
+    # one toggle per rule, plus a slider for threshold rules
+    values = {}
+    c1, c2 = st.columns(2)
+    for rule in BUY_RULES:
+        options = list(model['masks'][rule['name']])
+        on = c1.checkbox(rule['label'], value=True, key='whatif_' + rule['name'])
+        if len(options) > 1:
+            # column rules are moved as a fraction of the compared column
+            text = ('{:.0%} of ' + rule['column']).format if 'column' in rule else str
+            value = c2.select_slider(rule['label'], options=options, value=rule_default(rule), format_func=text,
+                                     disabled=not on)
+        else:
+            value = options[0]
+            c2.write('')
+        values[rule['name']] = value if on else None
+
+    # one markup per pricing tier
+    markups = []
+    for bound, markup in MARKUP_TIERS:
+        text = 'Markup when price is below {:.0%} of the season median'.format(bound) if np.isfinite(bound) else 'Markup otherwise'
+        markups.append(st.slider(text, min_value=1.0, max_value=2.0, value=markup, step=0.05))
+
+    return values, markups
+
+def conclusion(store, whatif_model):
 
     if selected == 'Conclusion':
 
@@ -385,31 +333,36 @@ def conclusion(data):
         st.write(":small_orange_diamond: Considering the insights described before, the purchase opportunities were identified below. You can filter them by neighborhood:")
         st.write('')
 
-        # Select properties with "buy" feature
-        data = data.loc[data['status'] == 'buy', ['id', 'price', 'high_season', 'selling_price', 'profit', 'sqft_living', 'bedrooms', 'bathrooms', 'yr_built', 'zipcode', 'lat', 'long']].reset_index()
-        data = data.drop(columns='index')
+        # What-if - change the buy criteria and markups without reprocessing the dataset
+        with st.expander('WHAT-IF: CHANGE THE BUY CRITERIA AND MARKUPS'):
+            values, markups = whatif_panel(whatif_model)
+
+        defaults = {rule['name']: rule_default(rule) for rule in BUY_RULES}
+        if values != defaults or markups != [markup for bound, markup in MARKUP_TIERS]:
+            start = time.perf_counter()
+            store = whatif(whatif_model, values, markups)
+            st.caption('What-if recomputed in {:.0f} ms'.format((time.perf_counter() - start) * 1000))
 
         # Show all properties checkbox
-        all_zipcodes = np.sort(data['zipcode'].unique())
+        all_zipcodes = list(store['partitions'])
         all_options = st.checkbox("SHOW ALL PROPERTIES", value=True)
         st.write('')
 
         # Checkbox filter
         if all_options:
-            selected_option = all_zipcodes
+            data = store['data']
         else:
-            selected_option = st.multiselect('In which region would you like to buy a property? Choose a zipcode below:', all_zipcodes, default=98001)
-
-        data = data.loc[data['zipcode'].isin(selected_option), :]
+            selected_option = st.multiselect('In which region would you like to buy a property? Choose a zipcode below:', all_zipcodes, default=[z for z in [98001] if z in all_zipcodes])
+            data = select_zipcodes(store, selected_option)
 
-        # Round values
-        data['price'] = data['price'].astype(int)
-        data['selling_price'] = data['selling_price'].astype(int)
-        data['profit'] = data['profit'].astype(int)
-        data['sqft_living'] = data['sqft_living'].astype(int)
-        data['bathrooms'] = data['bathrooms'].round(0)
-        data['bathrooms'] = data['bathrooms'].astype(int)
-        data['yr_built'] = data['yr_built'].apply(lambda x: x.year)
+        # Location filter
+        if st.checkbox('SEARCH AROUND A LOCATION') and not store['data'].empty:
+            c1, c2, c3 = st.columns(3)
+            lat = c1.number_input('Latitude', value=float(store['data']['lat'].mean()), format='%.4f')
+            long = c2.number_input('Longitude', value=float(store['data']['long'].mean()), format='%.4f')
+            km = c3.slider('Radius (km)', min_value=0.5, max_value=50.0, value=2.0, step=0.5)
+            nearby = within_radius(store, lat, long, km)
+            data = data.loc[data.index.isin(nearby.index)]
 
 
         # == Metrics ==
@@ -439,24 +392,15 @@ def conclusion(data):
         st.write('')
 
         # Show map
-        density_map = folium.Map(location=[data['lat'].mean(),
-                                           data['long'].mean()],
-                                 default_zoom_start=15)
-
-        marker_cluster = MarkerCluster().add_to(density_map)
-        for name, row in data.iterrows():
-            folium.Marker([row['lat'], row['long']],
-                          popup='Price: US${0}. Advisable to sell in the {1} for US${2}. Profit: US${3}. Area: {4} sqft. Bedroom(s): {5}. Bathroom(s): {6}. Year built: {7}.'.format(
-                              row['price'],
-                              row['high_season'],
-                              row['selling_price'],
-                              row['profit'],
-                              row['sqft_living'],
-                              row['bedrooms'],
-                              row['bathrooms'],
-                              row['yr_built'])).add_to(marker_cluster)
-
-        folium_static(density_map)
+        if data.empty:
+            st.warning('No property matches the selected criteria.')
+        else:
+            html, stats = build_map(data)
+            st.caption('{points} properties - {kb:.0f} KB of map HTML built in {ms:.0f} ms'.format(**stats))
+
+            # send the HTML rendered by build_map instead of rendering the map again, at folium_static's default size
+            with stage('map_html', data):
+                components.html(html, width=700, height=510)
 
         # Conclusion
         st.markdown("<h1 style='text-align: center; color: black;'>Conclusion</h1>", unsafe_allow_html=True)
@@ -465,14 +409,36 @@ def conclusion(data):
 
     return None
 
+def profiling_panel(trace):
+
+    # one row per stage of this run, nested stages indented under the stage that called them
+    table = pd.DataFrame(trace, columns=['stage', 'depth', 'ms', 'rows_in', 'rows_out', 'memory_mb', 'cache'])
+    table['stage'] = ['· ' * depth + name for depth, name in zip(table['depth'], table['stage'])]
+    total = table.loc[table['depth'] == 0, 'ms'].sum()
+
+    with st.sidebar.expander('Profiling', expanded=True):
+        st.caption('{:.0f} ms in {} stages - memory is the change in resident memory of the whole process'.format(total, len(table)))
+        st.dataframe(table.drop(columns='depth').round(1))
+
+    return None
+
 if __name__ == "__main__":
 
-    # data extraction
     path = 'kc_house_data.csv'
-    data = get_data(path)
 
-    # transformation
-    introduction(data)
-    data = set_feature(data)
-    insights(data)
-    conclusion(data)
+    # each page and the artifacts it reads - only the selected page's artifacts are built,
+    # each one cached on first use
+    pages = {
+        'Introduction': (introduction, ['data', 'version']),
+        'Insights': (insights, ['cube', 'version']),
+        'Conclusion': (conclusion, ['store', 'whatif']),
+    }
+
+    # the whole run reads one snapshot, even if a newer one is swapped in meanwhile
+    with stage('page ' + selected):
+        snapshot = get_refresher(path)['snapshot']
+        page, artifacts = pages[selected]
+        page(*[snapshot_artifact(snapshot, name) for name in artifacts])
+
+    if DEBUG:
+        profiling_panel(trace)
@@ -0,0 +1,243 @@
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pipeline import (read_chunks, derive_features, classify, BUY_RULES, pricing_window, best_window,
+                      apply_pricing, MARKUP_TIERS)
+
+
+# columns of the buy report and their types
+REPORT_SCHEMA = pa.schema([('id', pa.int64()), ('price', pa.float64()), ('high_season', pa.string()),
+                           ('selling_price', pa.float64()), ('profit', pa.float64())])
+REPORT_COLUMNS = REPORT_SCHEMA.names
+
+# rows per id bucket - every bucket is held in memory on its own, so this bounds the peak
+BUCKET_ROWS = 250_000
+
+
+# == Quantile Sketch ==
+
+# a sketch is a Series of counts indexed by (group..., bucket), where bucket i holds prices in
+# (gamma ** (i - 1), gamma ** i] - any quantile read from it is within "accuracy" of the true value
+
+def sketch_gamma(accuracy):
+    return (1 + accuracy) / (1 - accuracy)
+
+def sketch_update(sketch, keys, price, accuracy):
+
+    # count the prices of one chunk per group and bucket, then merge into the running sketch
+    bucket = np.ceil(np.log(np.maximum(price.to_numpy(), 1)) / np.log(sketch_gamma(accuracy))).astype('int32')
+    counts = pd.Series(1, index=price.index).groupby(keys + [bucket], observed=True).sum()
+
+    return counts if sketch is None else sketch.add(counts, fill_value=0)
+
+def sketch_median(sketch, accuracy):
+
+    # bucket holding the middle value of each group, returned as the bucket's mid point
+    levels = list(range(sketch.index.nlevels - 1))
+    cumulative = sketch.groupby(level=levels).cumsum()
+    total = sketch.groupby(level=levels).transform('sum')
+    middle = cumulative[cumulative >= (total + 1) / 2].groupby(level=levels).head(1)
+
+    gamma = sketch_gamma(accuracy)
+    bucket = middle.index.get_level_values(-1).to_numpy()
+
+    return pd.Series(2 * gamma ** bucket / (gamma + 1), index=middle.index.droplevel(-1))
+
+
+# == Passes ==
+
+def count_rows(path):
+
+    # data rows of the CSV, counted in 1 MB blocks so the bucket count is known before spilling
+    rows = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            rows += block.count(b'\n')
+
+    return max(0, rows - 1)
+
+def bucket_count(rows, bucket_rows):
+    return max(1, -(-rows // bucket_rows))
+
+def bucket_path(folder, b):
+    return os.path.join(folder, 'bucket-{}.parquet'.format(b))
+
+def spill(chunks, folder, buckets):
+
+    # pass 1 - split the source by id so every sale of a property lands in the same bucket. Each bucket
+    # is one file that every chunk appends to, so the file count stays at "buckets"
+    rows = 0
+    writers = {}
+    try:
+        for chunk in chunks:
+            rows += len(chunk)
+
+            # remove rows with the outlier from the "bedrooms" column
+            chunk = chunk.loc[chunk['bedrooms'] != 33]
+
+            for b, part in chunk.groupby(chunk['id'] % buckets):
+                table = pa.Table.from_pandas(part, preserve_index=False)
+                if b not in writers:
+                    writers[b] = pq.ParquetWriter(bucket_path(folder, b), table.schema)
+                writers[b].write_table(table)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return rows
+
+def read_bucket(folder, b):
+
+    path = bucket_path(folder, b)
+    return pd.read_parquet(path) if os.path.exists(path) else None
+
+def spill_prices(folder, b, data, period):
+
+    # prices of one bucket split by zipcode, so exact medians can be taken one zipcode at a time
+    prices = pd.DataFrame({'zipcode': data['zipcode'], 'period': period, 'price': data['price']})
+    for zipcode, part in prices.groupby('zipcode', observed=True):
+        part.to_parquet(os.path.join(folder, 'prices-{}-{}.parquet'.format(zipcode, b)), index=False)
+
+    return None
+
+def exact_medians(folder):
+
+    # pass 2b - exact zipcode and zipcode-window medians, reading the prices of one zipcode at a time
+    files = glob.glob(os.path.join(folder, 'prices-*.parquet'))
+    zipcodes = sorted({int(os.path.basename(f).split('-')[1]) for f in files})
+    zipcode_medians, season_medians = {}, {}
+
+    for zipcode in zipcodes:
+        parts = glob.glob(os.path.join(folder, 'prices-{}-*.parquet'.format(zipcode)))
+        prices = pd.concat([pd.read_parquet(f) for f in parts], ignore_index=True)
+        zipcode_medians[zipcode] = prices['price'].median()
+        season_medians[zipcode] = prices.groupby('period', observed=True)['price'].median()
+        for f in parts:
+            os.remove(f)
+
+    season_medians = pd.concat(season_medians, names=['zipcode', 'period'])
+    return pd.Series(zipcode_medians, name='price').rename_axis('zipcode'), season_medians
+
+def latest_sales(folder, buckets, window, median, accuracy):
+
+    # pass 2 - keep the most recent sale per id and collect the zipcode price statistics
+    zipcode_sketch = season_sketch = None
+    properties = 0
+
+    for b in range(buckets):
+        data = read_bucket(folder, b)
+        if data is None:
+            continue
+
+        # keep only recent rows by dropping previous dates
+        data = data.sort_values(['id', 'date']).drop_duplicates(subset=['id'], keep='last')
+        data = derive_features(data.reset_index(drop=True))
+        properties += len(data)
+
+        period = pricing_window(data, window)
+        if median == 'exact':
+            spill_prices(folder, b, data, period)
+        else:
+            zipcode_sketch = sketch_update(zipcode_sketch, [data['zipcode']], data['price'], accuracy)
+            season_sketch = sketch_update(season_sketch, [data['zipcode'], period], data['price'], accuracy)
+
+        # replace the bucket with the deduplicated rows
+        data.to_parquet(bucket_path(folder, b), index=False)
+
+    # an empty or fully filtered feed (a normal nightly delta) has no prices to take medians of
+    if properties == 0:
+        return properties, None, None
+
+    if median == 'exact':
+        zipcode_medians, season_medians = exact_medians(folder)
+    else:
+        zipcode_medians = sketch_median(zipcode_sketch, accuracy)
+        season_medians = sketch_median(season_sketch, accuracy)
+
+    return properties, zipcode_medians, season_medians
+
+def bucket_reports(folder, buckets, zipcode_medians, season_medians, tiers):
+
+    # pass 3 - classify and price each bucket, yielding its buy rows. Without properties there are no
+    # medians, so a single empty report is yielded and the output still gets its header (or schema)
+    if zipcode_medians is None:
+        yield REPORT_SCHEMA.empty_table().to_pandas()
+        return
+
+    best = best_window(season_medians)
+    for b in range(buckets):
+        data = read_bucket(folder, b)
+        if data is None:
+            continue
+
+        data['median_price'] = zipcode_medians.reindex(data['zipcode']).to_numpy()
+        data['status'], checks = classify(data, BUY_RULES)
+        data = data.loc[data['status'] == 'buy'].copy()
+        data = apply_pricing(data, best, tiers)
+        yield data[REPORT_COLUMNS].astype({'high_season': str})
+
+def write_report(folder, buckets, zipcode_medians, season_medians, tiers, output):
+
+    # append the buy rows of each bucket to the report
+    writer = None
+    first = True
+    bought = 0
+
+    for report in bucket_reports(folder, buckets, zipcode_medians, season_medians, tiers):
+        bought += len(report)
+
+        if output.endswith('.parquet'):
+            table = pa.Table.from_pandas(report, schema=REPORT_SCHEMA, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output, table.schema)
+            writer.write_table(table)
+        else:
+            report.to_csv(output, mode='w' if first else 'a', header=first, index=False)
+        first = False
+
+    if writer is not None:
+        writer.close()
+
+    return bought
+
+def run(path, output, chunksize=100_000, buckets=None, window='season', median='exact', accuracy=0.01,
+        tiers=MARKUP_TIERS, bucket_rows=BUCKET_ROWS):
+
+    start = time.perf_counter()
+    buckets = buckets or bucket_count(count_rows(path), bucket_rows)
+    with tempfile.TemporaryDirectory() as folder:
+        rows = spill(read_chunks(path, chunksize), folder, buckets)
+        properties, zipcode_medians, season_medians = latest_sales(folder, buckets, window, median, accuracy)
+        bought = write_report(folder, buckets, zipcode_medians, season_medians, tiers, output)
+
+    return {'rows': rows, 'properties': properties, 'buy': bought, 'buckets': buckets,
+            'seconds': time.perf_counter() - start}
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Write the House Rocket buy report without the Streamlit app.')
+    parser.add_argument('path', help='sales CSV with the kc_house_data.csv columns')
+    parser.add_argument('output', help='report file, .csv or .parquet')
+    parser.add_argument('--chunksize', type=int, default=100_000, help='rows read at a time')
+    parser.add_argument('--buckets', type=int, default=None,
+                        help='id partitions spilled to disk - each one is held in memory on its own '
+                             '(default: one per --bucket-rows rows)')
+    parser.add_argument('--bucket-rows', type=int, default=BUCKET_ROWS, help='target rows per bucket')
+    parser.add_argument('--window', choices=['season', 'month', 'quarter'], default='season')
+    parser.add_argument('--median', choices=['exact', 'sketch'], default='exact',
+                        help='exact spills the prices and reads one zipcode at a time, sketch keeps bounded '
+                             'counts per zipcode')
+    parser.add_argument('--accuracy', type=float, default=0.01, help='relative error of the sketch medians')
+    args = parser.parse_args()
+
+    stats = run(args.path, args.output, args.chunksize, args.buckets, args.window, args.median, args.accuracy,
+                bucket_rows=args.bucket_rows)
+    print('{rows} rows in {buckets} buckets, {properties} properties, {buy} to buy in {seconds:.1f} s'.format(**stats))
@@ -0,0 +1,284 @@
+import argparse
+import functools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from pipeline import (read_data, latest_sales, derive_features, classify, set_pricing, set_feature, BUY_RULES,
+                      MARKUP_TIERS, build_state, ingest_sales, state_frame, hypothesis_cube, price_trend, build_store, build_map, build_whatif, whatif,
+                      rule_default)
+
+
+# stored results the runs are compared against
+BASELINE = 'benchmark.json'
+
+# most map HTML allowed: a fixed part for folium and leaflet, plus the data of each point
+MAP_BASE_KB = 40
+MAP_KB_PER_POINT = 0.1
+
+# ids of the n-th synthetic copy are shifted by n * ID_OFFSET - larger than any King County id
+ID_OFFSET = 10 ** 10
+
+
+# == Synthetic Data ==
+
+def synthesize(raw, scale, seed=0):
+
+    # "scale" copies of the source with new ids - zipcodes, dates (so seasons) and repeated sales are
+    # kept as they are, prices and coordinates get a small noise so the copies are not identical
+    rng = np.random.default_rng(seed)
+    copies = [raw]
+    for n in range(1, scale):
+        copy = raw.copy()
+        copy['id'] = copy['id'] + n * ID_OFFSET
+        copy['price'] = (copy['price'] * rng.lognormal(0, 0.05, len(copy))).round()
+        copy['lat'] = copy['lat'] + rng.normal(0, 0.001, len(copy))
+        copy['long'] = copy['long'] + rng.normal(0, 0.001, len(copy))
+        copies.append(copy)
+
+    return pd.concat(copies, ignore_index=True)
+
+
+# == Reference ==
+
+def reference(raw):
+
+    # the original set_feature reduced to what decides status, selling_price and profit - its merges are
+    # kept, its row loops are written as np.where
+    data = raw.copy()
+    data['date'] = pd.to_datetime(data['date'])
+    data = data.drop(data[data['bedrooms'] == 33].index)
+    data = data.sort_values(['id', 'date'])
+    data = data.drop_duplicates(subset=['id'], keep='last').reset_index(drop=True)
+
+    month = data['date'].dt.month
+    data['season'] = np.select([month.between(6, 8), month.between(9, 11), month.isin([12, 1, 2])],
+                               ['Summer', 'Fall', 'Winter'], 'Spring')
+
+    grouped = data[['zipcode', 'price']].groupby('zipcode').median().reset_index()
+    data = pd.merge(data, grouped.rename(columns={'price': 'median_price'}), on='zipcode', how='inner')
+
+    buy = ((data['price'] <= data['median_price']) & (data['condition'] >= 4) & (data['waterfront'] == 0) &
+           (data['sqft_basement'] == 0) & (data['floors'] == 1) & (data['bedrooms'] <= 2) & (data['bathrooms'] <= 1))
+    data['status'] = np.where(buy, 'buy', "don't buy")
+
+    grouped = data[['season', 'zipcode', 'price']].groupby(['zipcode', 'season']).median().reset_index()
+    grouped = grouped.sort_values(['zipcode', 'price']).drop_duplicates(subset=['zipcode'], keep='last')
+    grouped = grouped.rename(columns={'season': 'high_season', 'price': 'season_median_price'})
+    data = pd.merge(data, grouped, on='zipcode', how='inner')
+
+    data['selling_price'] = np.where(data['price'] < data['season_median_price'], data['price'] * 1.30,
+                                     data['price'] * 1.10)
+    data['profit'] = data['selling_price'] - data['price']
+
+    return data
+
+def equivalent(data, raw):
+
+    # same properties with the same status, selling price and profit as the reference
+    expected = reference(raw).sort_values('id').reset_index(drop=True)
+    data = data.sort_values('id').reset_index(drop=True)
+
+    return (len(data) == len(expected) and (data['id'].to_numpy() == expected['id'].to_numpy()).all() and
+            (data['status'].astype(str).to_numpy() == expected['status'].to_numpy()).all() and
+            np.allclose(data['selling_price'].astype(float), expected['selling_price']) and
+            np.allclose(data['profit'].astype(float), expected['profit']))
+
+
+def handles_empty(raw, data, folder):
+
+    # a source without sales and one without buy candidates (only houses over 3 bedrooms) build an empty
+    # store instead of failing
+    sizes = []
+    for n, part in enumerate([raw.iloc[:0], raw.loc[raw['bedrooms'] > 3]]):
+        path = os.path.join(folder, 'empty-{}.csv'.format(n))
+        part.to_csv(path, index=False)
+        store = build_store(set_feature(read_data(path)))
+        sizes.append(len(store['data']) + len(store['partitions']))
+
+    # and so do what-if criteria no property meets - condition 5 with at most half a bathroom
+    values = dict({rule['name']: rule_default(rule) for rule in BUY_RULES}, good_condition=5, up_to_1_bathroom=0.5)
+    store = whatif(build_whatif(data), values, [markup for bound, markup in MARKUP_TIERS])
+    sizes.append(len(store['data']) + len(store['partitions']))
+
+    return sizes == [0, 0, 0]
+
+
+def replays(path, share=0.8):
+
+    # the first 80% of the sales (by date) through set_feature and the rest one day at a time through
+    # ingest_sales end with the same properties, status, high season and prices as set_feature on all of them
+    data = read_data(path)
+    cut = data['date'].quantile(share)
+    state = build_state(set_feature(data.loc[data['date'] <= cut].reset_index(drop=True)))
+    for day, sales in data.loc[data['date'] > cut].groupby('date'):
+        ingest_sales(state, sales)
+
+    columns = ['id', 'status', 'high_season', 'median_price', 'selling_price', 'profit']
+    replayed = state_frame(state)[columns].astype({'status': str, 'high_season': str})
+    expected = set_feature(data)[columns].astype({'status': str, 'high_season': str})
+
+    return (len(replayed) == len(expected) and
+            replayed[['id', 'status', 'high_season']].equals(expected[['id', 'status', 'high_season']]) and
+            np.allclose(replayed[columns[3:]], expected[columns[3:]]))
+
+
+# == Stages ==
+
+def stage_features(data):
+    data = derive_features(latest_sales(data))
+    data['median_price'] = data.groupby('zipcode', observed=True)['price'].transform('median')
+    return data
+
+def stage_classify(data):
+    data['status'], checks = classify(data, BUY_RULES)
+    return data
+
+def stage_insights(data):
+
+    # the trend as shown, and merged down to years - the 13 months of the data make 5 quarters
+    cube = hypothesis_cube(data)
+    return cube, price_trend(cube, 36), price_trend(cube, 4)
+
+def stage_map(store):
+    return build_map(store['data'])
+
+# each stage, the stage whose output it reads (None for the source path) and the function timed -
+# set_feature is split into features, classify and pricing
+STAGES = [
+    ('load', None, read_data),
+    ('features', 'load', stage_features),
+    ('classify', 'features', stage_classify),
+    ('pricing', 'classify', set_pricing),
+    ('insights', 'pricing', stage_insights),
+    ('store', 'pricing', build_store),
+    ('map', 'store', stage_map),
+]
+
+def measure(function, argument, repeat):
+
+    # best wall time of "repeat" runs, then one traced run for the peak memory - tracing slows python code
+    # down, so it is kept out of the timed runs. Each run gets its own copy, since stages add columns
+    seconds = []
+    for _ in range(repeat):
+        value = argument.copy() if isinstance(argument, pd.DataFrame) else argument
+        start = time.perf_counter()
+        output = function(value)
+        seconds.append(time.perf_counter() - start)
+
+    value = argument.copy() if isinstance(argument, pd.DataFrame) else argument
+    tracemalloc.start()
+    function(value)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return output, {'seconds': min(seconds), 'peak_mb': peak / 2 ** 20}
+
+def run(path, scale, repeat, workers=(1,)):
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        # the load stage parses a CSV, so the synthetic data is written as one
+        raw = pd.read_csv(path)
+        if scale > 1:
+            raw = synthesize(raw, scale)
+            path = os.path.join(folder, 'synthetic.csv')
+            raw.to_csv(path, index=False)
+
+        outputs, results = {}, {}
+        for name, source, function in STAGES:
+            outputs[name], results[name] = measure(function, path if source is None else outputs[source], repeat)
+
+        # set_feature as a whole with each worker count, to see how it scales - peak memory only counts
+        # the parent process
+        for n in workers:
+            output, results['set_feature/{}'.format(n)] = measure(functools.partial(set_feature, workers=n),
+                                                                  outputs['load'], repeat)
+
+        # size of the map page against its budget
+        stats = outputs['map'][1]
+        results['map_kb'] = stats['kb']
+        results['map_within_budget'] = bool(stats['kb'] <= MAP_BASE_KB + MAP_KB_PER_POINT * stats['points'])
+
+        results['rows'] = len(raw)
+        serial = set_feature(read_data(path))
+        results['equivalent'] = bool(equivalent(serial, raw))
+
+        # sharded runs give exactly the serial output
+        results['workers_match'] = all(set_feature(read_data(path), workers=n).equals(serial) for n in workers)
+        results['handles_empty'] = bool(handles_empty(raw, outputs['pricing'], folder))
+
+    return results
+
+def regressions(results, baseline, tolerance):
+
+    # stages slower or bigger than the baseline by more than "tolerance", ignoring differences under
+    # 10 ms and 1 MB, which are noise
+    found = []
+    for scale, stages in results.items():
+        for name, stats in stages.items():
+            before = baseline.get(scale, {}).get(name)
+            if not isinstance(stats, dict) or before is None:
+                continue
+            for key, floor in [('seconds', 0.01), ('peak_mb', 1)]:
+                if stats[key] > before[key] * (1 + tolerance) and stats[key] - before[key] > floor:
+                    found.append('{}x {} {}: {:.3f} -> {:.3f}'.format(scale, name, key, before[key], stats[key]))
+
+    return found
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Time and memory of each House Rocket stage at several data scales.')
+    parser.add_argument('path', nargs='?', default='kc_house_data.csv', help='sales CSV with the kc_house_data.csv columns')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help='copies of the source to run on')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the best one is kept')
+    parser.add_argument('--baseline', default=BASELINE, help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown or growth over the baseline')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1],
+                        help='processes to run set_feature over, timed as "set_feature/<workers>"')
+    parser.add_argument('--save', action='store_true', help='store these results as the new baseline')
+    args = parser.parse_args()
+
+    results = {}
+    print('{:>5} {:<14} {:>10} {:>10}'.format('scale', 'stage', 'seconds', 'peak MB'))
+    for scale in args.scales:
+        results[str(scale)] = run(args.path, scale, args.repeat, args.workers)
+        for name, stats in results[str(scale)].items():
+            if isinstance(stats, dict):
+                print('{:>4}x {:<14} {:>10.3f} {:>10.1f}'.format(scale, name, stats['seconds'], stats['peak_mb']))
+        print('{:>4}x map {:.0f} KB, {}'.format(scale, results[str(scale)]['map_kb'],
+                                              'within budget' if results[str(scale)]['map_within_budget']
+                                              else 'OVER BUDGET'))
+        print('{:>4}x {} rows, {}'.format(scale, results[str(scale)]['rows'],
+                                          'same status, selling_price and profit as the reference'
+                                          if results[str(scale)]['equivalent'] else 'DIFFERENT from the reference'))
+        print('{:>4}x set_feature with workers={} {}'.format(
+            scale, ', '.join(map(str, args.workers)),
+            'matches the serial output' if results[str(scale)]['workers_match'] else 'DIFFERENT from the serial output'))
+        print('{:>4}x empty sources {}'.format(scale, 'handled' if results[str(scale)]['handles_empty'] else 'FAIL'))
+
+    # incremental ingestion replayed once on the source - a day at a time it is too slow for the larger scales
+    replayed = replays(args.path)
+    print('ingest_sales replay {}'.format('matches set_feature' if replayed else 'DIFFERENT from set_feature'))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    found = regressions(results, baseline, args.tolerance)
+    for line in found:
+        print('regression', line)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(baseline, **results), f, indent=2)
+
+    # non-zero exit when a check fails, so the suite can gate a change
+    checks = ['equivalent', 'workers_match', 'handles_empty', 'map_within_budget']
+    sys.exit(1 if found or not replayed or not all(r[check] for r in results.values() for check in checks) else 0)
@@ -0,0 +1,93 @@
+import argparse
+import functools
+import multiprocessing
+
+from pipeline import build_snapshot, snapshot_artifact, hypothesis_cube, view
+
+
+# == Memory ==
+
+def memory():
+
+    # resident and proportional set size of this process in MB - pss splits pages shared by several
+    # processes (like a mapped snapshot) between them, so the pss of all workers adds up to the real usage
+    sizes = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ('Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:'):
+                sizes[parts[0][:-1]] = int(parts[1]) / 1024
+
+    return {'rss': sizes['Rss'], 'pss': sizes['Pss'], 'private': sizes['Private_Clean'] + sizes['Private_Dirty']}
+
+
+# == Sessions ==
+
+def session(data):
+
+    # what one page visit keeps around: the hypothesis cube and one page of the dataset viewer
+    return hypothesis_cube(data), view(data, list(data.columns)[:8], 1, 50)[0]
+
+def worker(path, mode, sessions, barrier, results):
+
+    # "shared" reads one snapshot per process like the app's refresher singleton, "copy" gives every
+    # session its own frame like a memoized (pickled and copied) dataset did
+    shared = functools.lru_cache()(build_snapshot)
+    def open_session():
+        if mode == 'shared':
+            data = snapshot_artifact(shared(path), 'features')
+        else:
+            data = snapshot_artifact(build_snapshot(path), 'features').copy()
+        return data, session(data)
+
+    # every measure waits for all workers, so shared pages are split between all of them
+    kept = []
+    barrier.wait()
+    before = memory()
+    kept.append(open_session())
+    barrier.wait()
+    first = memory()
+    kept.extend(open_session() for _ in range(sessions - 1))
+    barrier.wait()
+    last = memory()
+    results.put({'first': first['pss'] - before['pss'], 'extra': last['pss'] - first['pss']})
+    barrier.wait()
+
+    return None
+
+def run(path, mode, processes, sessions):
+
+    # spawned workers start empty, like separate "streamlit run" processes
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    workers = [context.Process(target=worker, args=(path, mode, sessions, barrier, results)) for _ in range(processes)]
+    for w in workers:
+        w.start()
+    deltas = [results.get() for _ in workers]
+    for w in workers:
+        w.join()
+
+    # pss in MB added by the first session of every process, and by each later session
+    first = sum(d['first'] for d in deltas)
+    extra = sum(d['extra'] for d in deltas) / max(1, processes * (sessions - 1))
+
+    return {'first': first, 'extra': extra, 'total': first + extra * processes * (sessions - 1)}
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Memory used by the transformed dataset as processes and sessions grow (Linux only).')
+    parser.add_argument('path', nargs='?', default='kc_house_data.csv', help='sales CSV with the kc_house_data.csv columns')
+    parser.add_argument('--processes', type=int, default=4, help='most worker processes, like "streamlit run" processes')
+    parser.add_argument('--sessions', type=int, default=8, help='sessions per process')
+    args = parser.parse_args()
+
+    # build the snapshot up front so workers only map it
+    snapshot_artifact(build_snapshot(args.path), 'features')
+
+    print('{:<8} {:>9} {:>8} {:>10} {:>14} {:>10}'.format('mode', 'processes', 'sessions', 'first MB', 'per session MB', 'total MB'))
+    for mode in ['shared', 'copy']:
+        for processes in sorted({1, args.processes}):
+            stats = run(args.path, mode, processes, args.sessions)
+            print('{:<8} {:>9} {:>8} {:>10.1f} {:>14.2f} {:>10.1f}'.format(
+                mode, processes, args.sessions, stats['first'], stats['extra'], stats['total']))
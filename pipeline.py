@@ -0,0 +1,1072 @@
+import pandas as pd
+import numpy as np
+import operator
+import hashlib
+import os
+import io
+import time
+import threading
+import functools
+import contextlib
+import logging
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+
+
+# == Instrumentation ==
+
+# one JSON line per stage when set: "1" writes to stderr, anything else is a file to append to
+PROFILE_LOG = os.environ.get('HOUSE_ROCKET_PROFILE_LOG')
+
+# stages of the current run - every Streamlit session runs its script in its own thread
+TRACE = threading.local()
+
+LOGGER = logging.getLogger('house_rocket.profile')
+if PROFILE_LOG:
+    LOGGER.addHandler(logging.StreamHandler() if PROFILE_LOG == '1' else logging.FileHandler(PROFILE_LOG))
+    LOGGER.setLevel(logging.INFO)
+    LOGGER.propagate = False
+
+def rss_mb():
+
+    # resident memory of the whole process in MB - Linux only, None elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+def row_count(value):
+
+    # rows of a frame, of a store or snapshot ("data" key) or of the first item of a tuple
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, dict):
+        value = value.get('data')
+
+    return len(value) if isinstance(value, (pd.DataFrame, pd.Series)) else None
+
+def start_trace(session=None):
+
+    # records of the stages run by this thread from now on, in the order they start
+    TRACE.records, TRACE.depth, TRACE.session = [], 0, session
+
+    return TRACE.records
+
+@contextlib.contextmanager
+def stage(name, data=None):
+
+    # duration, rows, process memory delta and cache use of one stage - callers fill "rows_out" and "cache"
+    depth = getattr(TRACE, 'depth', 0)
+    record = {'stage': name, 'depth': depth, 'ms': None, 'rows_in': row_count(data), 'rows_out': None,
+              'memory_mb': None, 'cache': None}
+    records = getattr(TRACE, 'records', None)
+    if records is not None:
+        records.append(record)
+
+    TRACE.depth = depth + 1
+    before, start = rss_mb(), time.perf_counter()
+    try:
+        yield record
+    finally:
+        TRACE.depth = depth
+        record['ms'] = (time.perf_counter() - start) * 1000
+        after = rss_mb()
+        record['memory_mb'] = None if before is None or after is None else after - before
+        if PROFILE_LOG:
+            LOGGER.info(json.dumps(dict(record, time=time.time(), pid=os.getpid(),
+                                        session=getattr(TRACE, 'session', None))))
+
+def instrumented(function):
+
+    # records each call of "function" as a stage named after it
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with stage(function.__name__, args[0] if args else None) as record:
+            result = function(*args, **kwargs)
+            record['rows_out'] = row_count(result)
+        return result
+
+    return wrapper
+
+
+# == Schema ==
+
+# smallest safe type for each column used by the app
+DATA_SCHEMA = {
+    'id': 'int64',
+    'date': 'str',
+    'price': 'float64',
+    'bedrooms': 'uint8',
+    'bathrooms': 'float32',
+    'sqft_living': 'int32',
+    'sqft_lot': 'int32',
+    'floors': 'float32',
+    'waterfront': 'uint8',
+    'view': 'uint8',
+    'condition': 'uint8',
+    'grade': 'uint8',
+    'sqft_above': 'int32',
+    'sqft_basement': 'int32',
+    'yr_built': 'int16',
+    'yr_renovated': 'int16',
+    'zipcode': 'int32',
+    'lat': 'float64',
+    'long': 'float64',
+}
+
+# columns stored as categories after reading
+CATEGORY_COLUMNS = ['zipcode']
+
+# format of the "date" column, e.g. 20141013T000000
+DATE_FORMAT = '%Y%m%dT%H%M%S'
+
+@instrumented
+def read_data(path):
+
+    # read only the columns in the schema, already typed
+    data = pd.read_csv(path, usecols=list(DATA_SCHEMA), dtype=DATA_SCHEMA)
+
+    # parse dates with the known format instead of inferring it
+    data['date'] = pd.to_datetime(data['date'], format=DATE_FORMAT)
+
+    # low cardinality columns as categories
+    for col in CATEGORY_COLUMNS:
+        data[col] = data[col].astype('category')
+
+    return data
+
+def read_chunks(path, chunksize):
+
+    # typed chunks of the source - no categories, so chunks can be concatenated later
+    for chunk in pd.read_csv(path, usecols=list(DATA_SCHEMA), dtype=DATA_SCHEMA, chunksize=chunksize):
+        chunk['date'] = pd.to_datetime(chunk['date'], format=DATE_FORMAT)
+        yield chunk
+
+def memory_report(path, data=None):
+
+    # bytes per column with inferred types and with the schema - "data" is the source already read
+    # with the schema, so the file is only parsed once
+    before = pd.read_csv(path).memory_usage(index=False, deep=True)
+    after = (read_data(path) if data is None else data).memory_usage(index=False, deep=True)
+
+    report = pd.DataFrame({'before': before, 'after': after}).reindex(before.index).fillna(0).astype('int64')
+    report.loc['total'] = report.sum()
+    report['ratio'] = (report['before'] / report['after'].replace(0, np.nan)).round(1)
+
+    return report
+
+# == Buy Rules ==
+
+# each rule compares a feature against a fixed value or against another column
+BUY_RULES = [
+    {'name': 'price_below_median', 'label': 'Price up to the zipcode median', 'feature': 'price', 'op': '<=', 'column': 'median_price'},
+    {'name': 'good_condition', 'label': 'Minimum condition', 'feature': 'condition', 'op': '>=', 'value': 4},
+    {'name': 'no_waterfront', 'label': 'No waterfront', 'feature': 'waterfront', 'op': '==', 'value': 0},
+    {'name': 'no_basement', 'label': 'No basement', 'feature': 'sqft_basement', 'op': '==', 'value': 0},
+    {'name': 'ground_floor', 'label': 'Maximum floors', 'feature': 'floors', 'op': '<=', 'value': 1},
+    {'name': 'up_to_2_bedrooms', 'label': 'Maximum bedrooms', 'feature': 'bedrooms', 'op': '<=', 'value': 2},
+    {'name': 'up_to_1_bathroom', 'label': 'Maximum bathrooms', 'feature': 'bathrooms', 'op': '<=', 'value': 1},
+]
+
+RULE_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda s, v: s.isin(v),
+}
+
+STATUS_TYPE = pd.CategoricalDtype(['buy', "don't buy"])
+
+def evaluate_rules(data, rules):
+
+    # one boolean column per rule
+    checks = pd.DataFrame(index=data.index)
+    for rule in rules:
+
+        # compare against another column or against a fixed value
+        other = data[rule['column']] if 'column' in rule else rule['value']
+        checks[rule['name']] = RULE_OPERATORS[rule['op']](data[rule['feature']], other).to_numpy(dtype=bool)
+
+    return checks
+
+@instrumented
+def classify(data, rules):
+
+    # per-rule pass/fail breakdown
+    checks = evaluate_rules(data, rules)
+
+    # a property is bought only when it passes every rule
+    buy = checks.all(axis=1).to_numpy()
+    status = pd.Categorical.from_codes(np.where(buy, 0, 1), dtype=STATUS_TYPE)
+
+    return pd.Series(status, index=data.index), checks
+
+# == Pricing ==
+
+# (upper bound of price / season_median_price, markup) - the first matching tier applies
+MARKUP_TIERS = [(1.0, 1.30), (np.inf, 1.10)]
+
+def pricing_window(data, window):
+
+    # label each sale with the period it belongs to
+    if window == 'season':
+        return data['season']
+    if window == 'month':
+        return data['date'].dt.month
+    if window == 'quarter':
+        return data['date'].dt.quarter
+
+    raise ValueError("window must be 'season', 'month' or 'quarter', got {!r}".format(window))
+
+def best_window(medians):
+
+    # keep the window with the highest median in each zipcode (ties go to the last window)
+    best = medians.rename_axis(['zipcode', 'high_season']).rename('season_median_price').reset_index()
+    best = best.sort_values(['season_median_price', 'high_season']).drop_duplicates('zipcode', keep='last')
+
+    return best.set_index('zipcode')
+
+def markup_tier(data, tiers=MARKUP_TIERS):
+
+    # index of the first tier whose bound is above price / season_median_price
+    bounds = np.array([bound for bound, markup in tiers], dtype=float)
+    ratio = (data['price'] / data['season_median_price']).to_numpy()
+
+    return np.minimum(np.searchsorted(bounds, ratio, side='right'), len(tiers) - 1)
+
+def apply_pricing(data, best, tiers=MARKUP_TIERS):
+
+    # align the best window back onto every row by zipcode
+    data['high_season'] = best['high_season'].reindex(data['zipcode']).to_numpy()
+    data['season_median_price'] = best['season_median_price'].reindex(data['zipcode']).to_numpy()
+
+    # selling price and profit
+    markups = np.array([markup for bound, markup in tiers], dtype=float)
+    data['selling_price'] = data['price'].to_numpy() * markups[markup_tier(data, tiers)]
+    data['profit'] = data['selling_price'] - data['price']
+
+    return data
+
+@instrumented
+def set_pricing(data, window='season', tiers=MARKUP_TIERS):
+
+    # median price per zipcode and window - a small (zipcode x window) table
+    period = pricing_window(data, window)
+    medians = data['price'].groupby([data['zipcode'], period], observed=True).median()
+
+    return apply_pricing(data, best_window(medians), tiers)
+
+# == Hypothesis Features ==
+
+# labels of each two-valued hypothesis column, as (false label, true label)
+WATERFRONT_TYPE = pd.CategoricalDtype(['no', 'yes'])
+BUILT_TYPE = pd.CategoricalDtype(['after', 'before'])
+BASEMENT_TYPE = pd.CategoricalDtype(['basement', 'no basement'])
+FLOOR_TYPE = pd.CategoricalDtype(['ground floor', 'more floors'])
+RENOVATED_TYPE = pd.CategoricalDtype(['not renovated', 'renovated'])
+RENOVATED_2010_TYPE = pd.CategoricalDtype(['after', 'before'])
+CONDITION_TYPE = pd.CategoricalDtype(['bad', 'good'])
+BEDROOMS_TYPE = pd.CategoricalDtype(['more than 2', 'up to 2'])
+BATHROOMS_TYPE = pd.CategoricalDtype(['more than 1', 'up to 1'])
+
+# season of each month, indexed by month number (index 0 is unused)
+SEASON_TYPE = pd.CategoricalDtype(['Fall', 'Spring', 'Summer', 'Winter'])
+SEASON_CODES = np.array([-1, 3, 3, 1, 1, 1, 2, 2, 2, 0, 0, 0, 3], dtype='int8')
+
+def label(mask, dtype):
+
+    # boolean mask to a two-category column - False is the first category, True the second
+    return pd.Categorical.from_codes(np.asarray(mask, dtype='int8'), dtype=dtype)
+
+@instrumented
+def derive_features(data):
+
+    # H1
+    # waterfront option ("yes" or "no")
+    data['waterfront_option'] = label(data['waterfront'] == 1, WATERFRONT_TYPE)
+
+    # H2
+    # before and after 1955 values
+    data['is_before_1955'] = label(data['yr_built'] < 1955, BUILT_TYPE)
+
+    # H3
+    # basement option
+    data['basement_option'] = label(data['sqft_basement'] == 0, BASEMENT_TYPE)
+
+    # H4
+    # year of sale
+    data['year'] = data['date'].dt.year.astype('int16')
+
+    # H5
+    # first day of the month of sale
+    data['month_year'] = data['date'].to_numpy().astype('datetime64[M]').astype('datetime64[ns]')
+
+    # H6
+    # floor amount
+    data['is_floor'] = label(data['floors'] != 1, FLOOR_TYPE)
+
+    # H7
+    # month and season of sale
+    data['month'] = data['date'].dt.month.astype('int8')
+    data['season'] = pd.Categorical.from_codes(SEASON_CODES[data['month'].to_numpy()], dtype=SEASON_TYPE)
+
+    # H8
+    # a "yr_renovated" equal to 0 means the property was never renovated
+    data['renovated'] = data['yr_renovated'] > 0
+    data['is_renovated'] = label(data['renovated'], RENOVATED_TYPE)
+
+    # H9
+    # before and after 2010 renovation values (never renovated counts as before)
+    data['renovated_2010'] = label(data['yr_renovated'] < 2010, RENOVATED_2010_TYPE)
+
+    # H10
+    # condition type
+    data['condition_type'] = label(data['condition'] >= 4, CONDITION_TYPE)
+
+    # H11
+    # bedroom amount
+    data['bedrooms_amount'] = label(data['bedrooms'] <= 2, BEDROOMS_TYPE)
+
+    # H12
+    # bathroom amount
+    data['bathrooms_amount'] = label(data['bathrooms'] <= 1, BATHROOMS_TYPE)
+
+    return data
+
+@instrumented
+def latest_sales(data):
+
+    # add new feature
+    data['price_m2'] = data['price'] / data['sqft_lot']
+
+
+    # == Line Filtering ==
+
+    # remove row with outlier from the "bedrooms" column
+    data = data.drop(data[data['bedrooms'] == 33].index)
+
+    # sort values by 'id' and 'date'
+    data = data.sort_values(['id', 'date'])
+
+    # keep only recent rows by dropping previous dates
+    data = data.drop_duplicates(subset=['id'], keep='last').reset_index()
+
+    # drop extra index column
+    data = data.drop(columns=['index'])
+
+    return data
+
+def score(data):
+
+    # everything below only looks at rows of the same zipcode
+
+    # == Hypotheses ==
+
+    # booleans and small categories instead of per-row strings
+    data = derive_features(data)
+
+    # median price per zipcode, aligned back onto every row
+    data['median_price'] = data.groupby('zipcode', observed=True)['price'].transform('median')
+
+    # == "Buy"/"Don't buy" Feature ==
+
+    # evaluate every buy rule over the whole frame at once
+    data['status'], checks = classify(data, BUY_RULES)
+
+
+    # == Selling Dataframe ==
+
+    # best window to sell in each zipcode and the selling price
+    data = set_pricing(data)
+
+    return data
+
+def shard(data, shards):
+
+    # spread whole zipcodes over the shards, biggest first, always onto the smallest shard
+    sizes = data['zipcode'].value_counts(sort=False)
+    sizes = sizes[sizes > 0].sort_index().sort_values(ascending=False, kind='mergesort')
+    loads = [0] * shards
+    owner = {}
+    for zipcode, size in sizes.items():
+        target = loads.index(min(loads))
+        owner[zipcode] = target
+        loads[target] += size
+
+    groups = pd.Series(owner).reindex(data['zipcode']).to_numpy()
+    return [data.loc[groups == n] for n in range(shards) if (groups == n).any()]
+
+@instrumented
+def set_feature(data, workers=1):
+
+    data = latest_sales(data)
+
+    if workers <= 1:
+        return score(data)
+
+    # score each zipcode shard in its own process and put the rows back in serial order. Workers are not
+    # forked: the app calls this from its refresh thread, and a fork taken while another thread holds a
+    # lock (logging, pyarrow) can deadlock the child
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        parts = list(pool.map(score, shard(data, workers)))
+
+    return pd.concat(parts).sort_index()
+
+# == Incremental Updates ==
+
+# the state keeps the scored rows split by zipcode (indexed by id), which zipcode each id
+# lives in, and the sorted prices of every zipcode and zipcode-season - an update only
+# touches the zipcodes of the sales it brings
+
+def build_state(data):
+
+    # scored set_feature output -> incremental state
+    data = data.astype({'zipcode': 'int32'}).set_index(data['id'].to_numpy())
+
+    state = {'zipcodes': {}, 'owner': {}, 'prices': {}, 'season_prices': {}}
+    for zipcode, frame in data.groupby('zipcode', sort=True):
+        state['zipcodes'][zipcode] = frame
+        state['prices'][zipcode] = np.sort(frame['price'].to_numpy())
+        state['season_prices'][zipcode] = {str(season): np.sort(prices.to_numpy())
+                                           for season, prices in frame.groupby('season', observed=True)['price']}
+        state['owner'].update(dict.fromkeys(frame.index.tolist(), zipcode))
+
+    return state
+
+def remove_price(prices, price):
+    return np.delete(prices, np.searchsorted(prices, price))
+
+def insert_price(prices, price):
+    return np.insert(prices, np.searchsorted(prices, price), price)
+
+def rescore(state, frame, tiers=MARKUP_TIERS):
+
+    # reclassify and reprice the rows of the touched zipcodes from their sorted prices
+    zipcodes = frame['zipcode'].unique()
+    medians = pd.Series({z: np.median(state['prices'][z]) for z in zipcodes})
+    frame['median_price'] = medians.reindex(frame['zipcode']).to_numpy()
+    frame['status'], checks = classify(frame, BUY_RULES)
+
+    medians = pd.Series({(z, season): np.median(prices) for z in zipcodes
+                         for season, prices in state['season_prices'][z].items() if len(prices)})
+
+    return apply_pricing(frame, best_window(medians), tiers)
+
+def ingest_sales(state, sales):
+
+    # same line filtering as latest_sales, inside the batch
+    sales = sales.loc[sales['bedrooms'] != 33]
+    sales = sales.sort_values(['id', 'date']).drop_duplicates(subset=['id'], keep='last')
+    sales = sales.astype({'zipcode': 'int32'}).reset_index(drop=True)
+    sales['price_m2'] = sales['price'] / sales['sqft_lot']
+    sales = derive_features(sales).set_index(sales['id'].to_numpy())
+
+    touched, removed, added = set(), [], []
+    for sale in sales[['id', 'date', 'price', 'zipcode', 'season']].itertuples(index=False):
+        zipcode = state['owner'].get(sale.id)
+
+        # drop the previous sale of the property, unless it is more recent than this one
+        if zipcode is not None:
+            old = state['zipcodes'][zipcode].loc[sale.id]
+            if old['date'] > sale.date:
+                continue
+            state['prices'][zipcode] = remove_price(state['prices'][zipcode], old['price'])
+            seasons = state['season_prices'][zipcode]
+            seasons[str(old['season'])] = remove_price(seasons[str(old['season'])], old['price'])
+            removed.append(sale.id)
+            touched.add(zipcode)
+
+        # add the new sale
+        state['owner'][sale.id] = sale.zipcode
+        state['prices'][sale.zipcode] = insert_price(state['prices'].get(sale.zipcode, np.empty(0)), sale.price)
+        seasons = state['season_prices'].setdefault(sale.zipcode, {})
+        seasons[str(sale.season)] = insert_price(seasons.get(str(sale.season), np.empty(0)), sale.price)
+        added.append(sale.id)
+        touched.add(sale.zipcode)
+
+    if not touched:
+        return []
+
+    # the rows of the touched zipcodes, with the new sales in place of the old ones
+    touched = sorted(touched)
+    frame = pd.concat([state['zipcodes'][z] for z in touched if z in state['zipcodes']] + [sales.iloc[:0]])
+    frame = pd.concat([frame.drop(index=removed), sales.loc[added]])
+
+    # rescore them together and split them back by zipcode
+    frame = rescore(state, frame)
+    for zipcode, part in frame.groupby('zipcode', sort=False):
+        state['zipcodes'][zipcode] = part
+
+    # zipcodes left without sales go away
+    for zipcode in touched:
+        if not len(state['prices'][zipcode]):
+            del state['zipcodes'][zipcode], state['prices'][zipcode], state['season_prices'][zipcode]
+
+    return touched
+
+def state_frame(state):
+
+    # full scored frame, in the same row order as set_feature
+    data = pd.concat(state['zipcodes'].values()).sort_index().reset_index(drop=True)
+    data['zipcode'] = data['zipcode'].astype('category')
+
+    return data
+
+# == Artifact Cache ==
+
+# bump whenever set_feature (or anything it calls) changes its output, or the artifact format changes
+PIPELINE_VERSION = 2
+
+# folder with the transformed datasets
+CACHE_DIR = '.cache'
+
+def file_hash(path):
+
+    # sha256 of the file content, read in 1 MB blocks
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def dataset_version(path, digest=None):
+
+    # identifies the (source content, pipeline version) pair - "digest" skips hashing the file again
+    return '{}-v{}'.format((digest or file_hash(path))[:16], PIPELINE_VERSION)
+
+def artifact_path(version, name='features'):
+
+    # one artifact per dataset version
+    return os.path.join(CACHE_DIR, '{}-{}.arrow'.format(name, version))
+
+@instrumented
+def write_snapshot(data, artifact):
+
+    # Arrow IPC file, written to a temporary file first so readers never see a partial snapshot
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = '{}.{}.tmp'.format(artifact, os.getpid())
+    with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp, artifact)
+
+    return None
+
+@instrumented
+def map_snapshot(artifact):
+
+    # numeric and date columns point straight into the mapped file, so every session and process shares
+    # one copy through the page cache - those columns are read-only, and writing to them raises
+    table = pa.ipc.open_file(pa.memory_map(artifact)).read_all()
+
+    return table.to_pandas(split_blocks=True)
+
+# (prefix, suffix) of the files evict removes - snapshots and the app's figure specs
+EVICTED = [('data-', '.arrow'), ('features-', '.arrow'), ('figure-', '.json')]
+
+def evict(version):
+
+    # remove artifacts (and figures) of older sources or pipeline versions. Build locks and temporary
+    # files may belong to another process still building an older version, so they are left alone
+    for entry in os.scandir(CACHE_DIR):
+        if (entry.is_file() and version not in entry.name and
+                any(entry.name.startswith(prefix) and entry.name.endswith(suffix) for prefix, suffix in EVICTED)):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry.path)
+
+    return None
+
+# == Hypothesis Cube ==
+
+# each hypothesis compares the mean price of "subject" against "baseline" - a negative claim means cheaper.
+# H5 has no baseline: its uplift is the month over month growth
+HYPOTHESES = [
+    {'id': 'H1', 'column': 'waterfront_option', 'subject': 'yes', 'baseline': 'no', 'claim': 0.30},
+    {'id': 'H6', 'column': 'is_floor', 'subject': 'ground floor', 'baseline': 'more floors', 'claim': -0.40},
+    {'id': 'H3', 'column': 'basement_option', 'subject': 'basement', 'baseline': 'no basement', 'claim': 0.20},
+    {'id': 'H2', 'column': 'is_before_1955', 'subject': 'before', 'baseline': 'after', 'claim': -0.50},
+    {'id': 'H5', 'column': 'month_year', 'claim': 0.15},
+    {'id': 'H10', 'column': 'condition_type', 'subject': 'good', 'baseline': 'bad', 'claim': 0.50},
+    {'id': 'H12', 'column': 'bathrooms_amount', 'subject': 'up to 1', 'baseline': 'more than 1', 'claim': -0.30},
+    {'id': 'H7', 'column': 'season', 'subject': 'Winter', 'baseline': 'Summer', 'claim': -0.20},
+    {'id': 'H11', 'column': 'bedrooms_amount', 'subject': 'up to 2', 'baseline': 'more than 2', 'claim': -0.20},
+    {'id': 'H9', 'column': 'renovated_2010', 'subject': 'after', 'baseline': 'before', 'claim': 0.40},
+    {'id': 'H8', 'column': 'is_renovated', 'subject': 'not renovated', 'baseline': 'renovated', 'claim': -0.30},
+]
+
+@instrumented
+def hypothesis_cube(data):
+
+    # one small groupby per hypothesis on its integer codes - peak memory stays at a few arrays of N rows
+    price = pd.Series(data['price'].to_numpy())
+    parts = []
+    for h in HYPOTHESES:
+
+        # integer code of each row's value, sorted like a groupby would
+        codes, uniques = pd.factorize(data[h['column']], sort=True)
+        uniques = pd.Index(uniques)
+        uniques = uniques.strftime('%Y-%m') if isinstance(uniques, pd.DatetimeIndex) else uniques.astype(str)
+
+        grouped = price.groupby(codes).agg(['mean', 'median', 'count']).reindex(range(len(uniques)))
+        grouped.insert(0, 'value', uniques)
+        grouped.insert(0, 'hypothesis', h['id'])
+        parts.append(grouped)
+
+    cube = pd.concat(parts, ignore_index=True)
+
+    # mean price relative to the baseline value (or to the previous month for H5)
+    cube['uplift'] = np.nan
+    for h in HYPOTHESES:
+        rows = cube['hypothesis'] == h['id']
+        mean = cube.loc[rows, 'mean']
+        if 'baseline' in h:
+            # NaN when the loaded data has no property with the baseline value
+            baseline = mean[cube.loc[rows, 'value'] == h['baseline']]
+            cube.loc[rows, 'uplift'] = mean / baseline.iloc[0] - 1 if len(baseline) else np.nan
+        else:
+            cube.loc[rows, 'uplift'] = mean.pct_change()
+
+    return cube.reset_index(drop=True)
+
+def hypothesis_data(cube, hypothesis):
+
+    # (value, mean price) of one hypothesis, named like the original columns
+    h = next(h for h in HYPOTHESES if h['id'] == hypothesis)
+    grouped = cube.loc[cube['hypothesis'] == hypothesis, ['value', 'mean']]
+
+    return grouped.rename(columns={'value': h['column'], 'mean': 'price'})
+
+@instrumented
+def price_trend(cube, max_points):
+
+    # H5 monthly averages, merged into quarters or years when there are more than "max_points" months
+    rows = cube.loc[cube['hypothesis'] == 'H5']
+    months = pd.PeriodIndex(rows['value'], freq='M')
+    for freq in ['M', 'Q', 'Y']:
+        periods = months.asfreq(freq)
+        if periods.nunique() <= max_points:
+            break
+
+    # count-weighted mean of the merged months
+    total = (rows['mean'] * rows['count']).groupby(periods).sum()
+    count = rows['count'].groupby(periods).sum()
+
+    return pd.DataFrame({'month_year': total.index.astype(str), 'price': (total / count).to_numpy()})
+
+def finding(cube, hypothesis):
+
+    # observed uplift of the subject (highest monthly growth for H5) and whether it backs the claim -
+    # NaN, which never backs it, when the subject or the baseline is missing from the data
+    h = next(h for h in HYPOTHESES if h['id'] == hypothesis)
+    rows = cube.loc[cube['hypothesis'] == hypothesis]
+    if 'subject' in h:
+        subject = rows.loc[rows['value'] == h['subject'], 'uplift']
+        uplift = subject.iloc[0] if len(subject) else np.nan
+    else:
+        uplift = rows['uplift'].max()
+
+    holds = uplift * np.sign(h['claim']) >= abs(h['claim'])
+
+    return uplift, holds
+
+# == Buy Store ==
+
+# columns shown on the Conclusion page
+STORE_COLUMNS = ['id', 'price', 'high_season', 'selling_price', 'profit', 'sqft_living', 'bedrooms', 'bathrooms', 'yr_built', 'zipcode', 'lat', 'long']
+
+# km per degree of latitude
+KM_PER_DEGREE = 110.574
+
+def project(lat, long, lat0):
+
+    # equirectangular projection to km - accurate enough at county scale
+    x = np.asarray(long, dtype=float) * KM_PER_DEGREE * np.cos(np.radians(lat0))
+    y = np.asarray(lat, dtype=float) * KM_PER_DEGREE
+
+    return np.column_stack([x, y])
+
+def round_candidates(data):
+
+    # rounded for display and sorted so each zipcode is one contiguous block
+    data = data.sort_values('zipcode', kind='mergesort').reset_index(drop=True)
+    data['zipcode'] = data['zipcode'].astype(int)
+    data['price'] = data['price'].astype(int)
+    data['selling_price'] = data['selling_price'].astype(int)
+    data['profit'] = data['profit'].astype(int)
+    data['sqft_living'] = data['sqft_living'].astype(int)
+    data['bathrooms'] = data['bathrooms'].round(0).astype(int)
+
+    return data
+
+def index_candidates(data):
+
+    # (start, stop) row range of each zipcode - none when no property is a candidate
+    partitions = {}
+    if len(data):
+        zipcodes = data['zipcode'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, zipcodes[1:] != zipcodes[:-1]])
+        stops = np.r_[starts[1:], len(data)]
+        partitions = {int(zipcodes[a]): (a, b) for a, b in zip(starts, stops)}
+
+    # kd-tree over the projected coordinates - scipy is imported here so pages without a map skip it
+    from scipy.spatial import cKDTree
+    lat0 = data['lat'].mean() if len(data) else 0.0
+    tree = cKDTree(project(data['lat'], data['long'], lat0))
+
+    return {'data': data, 'partitions': partitions, 'lat0': lat0, 'tree': tree}
+
+@instrumented
+def build_store(data):
+
+    # buy candidates only
+    return index_candidates(round_candidates(data.loc[data['status'] == 'buy', STORE_COLUMNS]))
+
+def select_zipcodes(store, zipcodes):
+
+    # slice only the selected partitions
+    ranges = [store['partitions'][z] for z in zipcodes if z in store['partitions']]
+    if not ranges:
+        return store['data'].iloc[:0]
+
+    return pd.concat([store['data'].iloc[a:b] for a, b in ranges])
+
+def within_radius(store, lat, long, km):
+
+    # candidates within "km" of the point
+    point = project([lat], [long], store['lat0'])[0]
+    rows = store['tree'].query_ball_point(point, km)
+
+    return store['data'].iloc[np.sort(rows)]
+
+def within_bbox(store, south, west, north, east):
+
+    # candidates in the circle around the box, then the exact box test
+    corners = project([south, north], [west, east], store['lat0'])
+    center = corners.mean(axis=0)
+    rows = np.sort(store['tree'].query_ball_point(center, np.linalg.norm(corners[1] - corners[0]) / 2))
+    data = store['data'].iloc[rows]
+
+    inside = data['lat'].between(south, north) & data['long'].between(west, east)
+    return data.loc[inside]
+
+# == What-if ==
+
+# fractions of the compared column a column rule can be moved to - 1.0 is the rule as declared
+WHATIF_FRACTIONS = np.round(np.arange(0.5, 1.55, 0.05), 2)
+
+def rule_default(rule):
+
+    # value of the rule as declared in BUY_RULES - rules comparing to a column start at 100% of it
+    return rule['value'] if 'value' in rule else 1.0
+
+@instrumented
+def build_whatif(data):
+
+    # one mask per rule - threshold rules get one mask per value seen in the data, column rules one mask
+    # per fraction of the compared column (e.g. price up to 90% of the zipcode median)
+    masks = {}
+    for rule in BUY_RULES:
+        if 'column' in rule:
+            feature, column = data[rule['feature']], data[rule['column']]
+            masks[rule['name']] = {f.item(): RULE_OPERATORS[rule['op']](feature, f * column).to_numpy()
+                                   for f in WHATIF_FRACTIONS}
+        elif rule['op'] not in ('<', '<=', '>', '>='):
+            masks[rule['name']] = {rule_default(rule): evaluate_rules(data, [rule])[rule['name']].to_numpy()}
+        else:
+            feature = data[rule['feature']]
+            values = np.union1d(feature.unique(), [rule['value']])
+            masks[rule['name']] = {v.item(): RULE_OPERATORS[rule['op']](feature, v).to_numpy() for v in values}
+
+    # every property with its markup tier, so a new markup is a single lookup
+    table = data[STORE_COLUMNS].copy()
+    table['tier'] = markup_tier(data)
+
+    return {'masks': masks, 'table': table}
+
+@instrumented
+def whatif(model, values, markups):
+
+    # "values" holds the threshold of each rule, or None to switch the rule off
+    mask = np.ones(len(model['table']), dtype=bool)
+    for name, value in values.items():
+        if value is not None:
+            mask &= model['masks'][name][value]
+
+    # selling price and profit with the chosen markups
+    data = model['table'].loc[mask]
+    data = data.assign(selling_price=data['price'].to_numpy() * np.asarray(markups, dtype=float)[data['tier'].to_numpy()])
+    data['profit'] = data['selling_price'] - data['price']
+
+    return index_candidates(round_candidates(data[STORE_COLUMNS]))
+
+# == Dataset Viewer ==
+
+@instrumented
+def view(data, columns, page, page_size, sort=None, ascending=True, zipcodes=None, price=None, order=None):
+
+    # rows passing the filters
+    mask = np.ones(len(data), dtype=bool)
+    if zipcodes:
+        mask &= data['zipcode'].isin(zipcodes).to_numpy()
+    if price:
+        mask &= data['price'].between(*price).to_numpy()
+
+    # positions of the matching rows in display order - "order" is a cached argsort of the sort column
+    if sort is None:
+        rows = np.flatnonzero(mask)
+    else:
+        order = np.argsort(data[sort].to_numpy(), kind='mergesort') if order is None else order
+        rows = order[mask[order]]
+        rows = rows if ascending else rows[::-1]
+
+    # copy only the rows and columns of the requested page
+    pages = max(1, -(-len(rows) // page_size))
+    page = min(max(1, int(page)), pages)
+    positions = rows[(page - 1) * page_size:page * page_size]
+    frame = data.iloc[positions, [data.columns.get_loc(c) for c in columns]]
+
+    stats = {'page': page, 'pages': pages, 'rows': len(frame), 'matches': len(rows), 'columns': len(columns),
+             'kb': frame.memory_usage(index=True, deep=True).sum() / 1024}
+
+    return frame, stats
+
+
+# == Map ==
+
+# popup fields, in the order the client-side callback reads them
+POPUP_COLUMNS = ['price', 'high_season', 'selling_price', 'profit', 'sqft_living', 'bedrooms', 'bathrooms', 'yr_built']
+
+POPUP_TEXT = 'Price: US${0}. Advisable to sell in the {1} for US${2}. Profit: US${3}. Area: {4} sqft. Bedroom(s): {5}. Bathroom(s): {6}. Year built: {7}.'
+
+# builds each marker in the browser from one [lat, long, *POPUP_COLUMNS] row
+MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup('Price: US$' + row[2] + '. Advisable to sell in the ' + row[3] + ' for US$' + row[4] +
+        '. Profit: US$' + row[5] + '. Area: ' + row[6] + ' sqft. Bedroom(s): ' + row[7] +
+        '. Bathroom(s): ' + row[8] + '. Year built: ' + row[9] + '.');
+    return marker;
+};
+"""
+
+@instrumented
+def build_map(data, fast=True):
+
+    # mapping stack is only needed on the Conclusion page
+    import folium
+    from folium.plugins import MarkerCluster, FastMarkerCluster
+
+    start = time.perf_counter()
+
+    density_map = folium.Map(location=[data['lat'].mean(),
+                                       data['long'].mean()],
+                             default_zoom_start=15)
+
+    if fast:
+        # one compact array for all properties, clustered client-side
+        rows = data[['lat', 'long'] + POPUP_COLUMNS].values.tolist()
+        FastMarkerCluster(rows, callback=MARKER_CALLBACK).add_to(density_map)
+
+    else:
+        # one folium.Marker per property
+        marker_cluster = MarkerCluster().add_to(density_map)
+        for row in data[['lat', 'long'] + POPUP_COLUMNS].itertuples(index=False):
+            folium.Marker([row[0], row[1]], popup=POPUP_TEXT.format(*row[2:])).add_to(marker_cluster)
+
+    # rendered once - the page sends this HTML as is, so its size is what the browser receives
+    html = density_map.get_root().render()
+    stats = {'points': len(data), 'kb': len(html) / 1024, 'ms': (time.perf_counter() - start) * 1000}
+
+    return html, stats
+
+# == Background Refresh ==
+
+# a snapshot holds one dataset version and everything built from it. Sessions take the current snapshot
+# once per run, and the refresh thread replaces it as a whole, so a run never mixes two versions
+
+# seconds between checks of the source file
+REFRESH_INTERVAL = 5
+
+# seconds after which a build lock left by a dead process is ignored
+BUILD_TIMEOUT = 600
+
+# artifacts built from the transformed dataset on first use
+DERIVED = {'cube': hypothesis_cube, 'store': build_store, 'whatif': build_whatif}
+
+# everything a snapshot builds lazily, in build order
+ARTIFACTS = ['features'] + list(DERIVED)
+
+REFRESH_LOGGER = logging.getLogger('house_rocket.refresh')
+
+def source_stamp(path):
+
+    # cheap change check - the source is only read and hashed again when its mtime or size moves
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def claim_build(version, name):
+
+    # lock file of the one process building this artifact, or None when another process holds it
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    lock = os.path.join(CACHE_DIR, 'build-{}-{}.lock'.format(name, version))
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        if time.time() - os.path.getmtime(lock) < BUILD_TIMEOUT:
+            return None
+        os.remove(lock)
+        return claim_build(version, name)
+
+    return lock
+
+def ensure_artifact(version, name, build, rebuild=False):
+
+    # only one process builds an artifact, the others wait for it - returns how it was obtained
+    artifact = artifact_path(version, name)
+    if os.path.exists(artifact) and not rebuild:
+        return 'hit'
+
+    lock = claim_build(version, name)
+    while lock is None and not os.path.exists(artifact):
+        time.sleep(0.1)
+        lock = claim_build(version, name)
+    if lock is None:
+        return 'wait'
+
+    try:
+        if os.path.exists(artifact) and not rebuild:
+            return 'wait'
+        write_snapshot(build(), artifact)
+    finally:
+        os.remove(lock)
+
+    return 'miss'
+
+def build_snapshot(path, rebuild=False, workers=1):
+
+    # only the typed source is mapped here - the transformed dataset is built on first use
+    with stage('build_snapshot') as record:
+
+        # one read of the source, so the version always matches the content the artifacts come from
+        stamp = source_stamp(path)
+        with open(path, 'rb') as f:
+            content = f.read()
+        version = dataset_version(path, hashlib.sha256(content).hexdigest())
+
+        record['cache'] = ensure_artifact(version, 'data', lambda: read_data(io.BytesIO(content)))
+        snapshot = {'version': version, 'stamp': stamp, 'data': map_snapshot(artifact_path(version, 'data')),
+                    'rebuild': rebuild, 'workers': workers, 'lock': threading.RLock()}
+        record['rows_out'] = len(snapshot['data'])
+
+    return snapshot
+
+def snapshot_features(snapshot):
+
+    # transformed dataset of the snapshot's version - a shallow copy keeps set_feature from adding
+    # columns to the shared source frame
+    version = snapshot['version']
+    with stage('load features') as record:
+        record['cache'] = ensure_artifact(version, 'features', lambda: set_feature(
+            snapshot['data'].copy(deep=False), snapshot['workers']), snapshot['rebuild'])
+        data = map_snapshot(artifact_path(version))
+        record['rows_out'] = len(data)
+
+    return data
+
+def snapshot_artifact(snapshot, name):
+
+    # the transformed dataset and the artifacts derived from it are added to the snapshot the first
+    # time a page asks for them
+    with stage('artifact ' + name) as record:
+        record['cache'] = 'hit' if name in snapshot else 'miss'
+        if name not in snapshot:
+            with snapshot['lock']:
+                if name not in snapshot:
+                    snapshot[name] = (snapshot_features(snapshot) if name == 'features' else
+                                      DERIVED[name](snapshot_artifact(snapshot, 'features')))
+        record['rows_out'] = row_count(snapshot[name])
+
+    return snapshot[name]
+
+def refresh(refresher):
+
+    # check the source, and once a change has settled for a whole interval, build the new version
+    # with all its artifacts before swapping it in
+    snapshot = refresher['snapshot']
+    stamp = source_stamp(refresher['path'])
+    seen, refresher['seen'] = refresher['seen'], stamp
+    if stamp == snapshot['stamp'] or stamp != seen or stamp == refresher['failed']:
+        return False
+
+    try:
+        new = build_snapshot(refresher['path'], workers=refresher['workers'])
+        if new['version'] == snapshot['version']:
+            # same content - the stamp is updated in place, so artifacts sessions are still adding to the
+            # current snapshot are kept
+            snapshot['stamp'] = new['stamp']
+            return False
+
+        for name in ARTIFACTS:
+            if name not in new:
+                snapshot_artifact(new, name)
+    except Exception:
+        # keep serving the current version until the source changes again
+        REFRESH_LOGGER.exception('refresh of %s failed, keeping version %s', refresher['path'], snapshot['version'])
+        refresher['failed'] = stamp
+        return False
+
+    # older versions are only removed once the new one is serving
+    refresher['snapshot'] = new
+    evict(new['version'])
+
+    return True
+
+def warm(refresher):
+
+    # build the derived artifacts of the current snapshot off the request path, once per version
+    snapshot = refresher['snapshot']
+    if refresher['warm'] == snapshot['version']:
+        return None
+
+    # only missing artifacts go through snapshot_artifact, so warm-ups never log "hit" stages
+    refresher['warm'] = snapshot['version']
+    for name in ARTIFACTS:
+        if name not in snapshot:
+            snapshot_artifact(snapshot, name)
+
+    return None
+
+def refresh_loop(refresher):
+
+    # a failure never ends the thread - it is logged and the next interval checks the source again
+    while True:
+        time.sleep(refresher['interval'])
+        try:
+            warm(refresher)
+            refresh(refresher)
+        except FileNotFoundError:
+            # the source is being replaced
+            continue
+        except Exception:
+            REFRESH_LOGGER.exception('refresh of %s failed', refresher['path'])
+
+def start_refresh(path, interval=REFRESH_INTERVAL, rebuild=False, workers=1):
+
+    # the current snapshot is always refresher['snapshot']
+    snapshot = build_snapshot(path, rebuild, workers)
+    evict(snapshot['version'])
+    refresher = {'path': path, 'snapshot': snapshot, 'interval': interval, 'workers': workers,
+                 'seen': snapshot['stamp'], 'failed': None, 'warm': None}
+    threading.Thread(target=refresh_loop, args=(refresher,), daemon=True).start()
+
+    return refresher